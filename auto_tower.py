@@ -1,5 +1,11 @@
+import ctypes
+import functools
 import os
+import queue
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 from time import sleep
 from typing import Optional, Tuple
 
@@ -9,46 +15,251 @@ import pyautogui
 import pygetwindow as gw
 import keyboard
 
+try:
+    import bettercam
+except ImportError:
+    bettercam = None
+
+try:
+    import mss
+except ImportError:
+    mss = None
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+try:
+    _USER32 = ctypes.windll.user32
+    _GDI32 = ctypes.windll.gdi32
+except AttributeError:
+    _USER32 = _GDI32 = None
+
+# pyautogui 默认每次调用后 sleep 0.1s 并检查鼠标是否在屏幕角落；需要的等待都显式写了 sleep，Q 键可随时退出
+pyautogui.PAUSE = 0.0
+pyautogui.FAILSAFE = False
+
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 RESOURCE_DIR = os.path.join(BASE_DIR, "resources")
 
 IMAGE_MATCH_THRESHOLD = 0.80
-
+# 界面图标对比度高，灰度匹配置信度基本不变但运算量只有彩色的 1/3；调试时可改回 False 用彩色匹配
+MATCH_GRAYSCALE = True
+# 灰度直接取绿色通道，省掉每帧的加权求和；彩色按钮（buy/confirm/next 等）的绿通道和亮度差别较大，默认关闭
+GRAY_FROM_GREEN = False
+# 金字塔匹配（只用于找单个目标的 match_template）：先在 1/2（模板够大时 1/4）分辨率上粗定位，再回到原图的小范围里确认
+# 每下采样一层要求模板短边再翻一倍，保证最粗一层的模板短边不小于 PYRAMID_MIN_TEMPLATE / 2
+PYRAMID_MIN_TEMPLATE = 32
+PYRAMID_LEVELS = 2
+# 同样尺寸的模板在 1/4 下的表现差别很大（start_battle 最差相位只有 0.44）：加载时把模板贴在纯色背景上、
+# 逐个像素相位下采样自匹配，最差得分不低于这个值才允许用这一层
+PYRAMID_PHASE_SCORE = 0.55
+PYRAMID_COARSE_RATIO = 0.6
+PYRAMID_CANDIDATES = 2
+PYRAMID_PAD = 8
+# find_all_matches 的非极大值抑制半径（像素），同一件商品的匹配峰不会离中心这么远
+MATCH_NMS_RADIUS = 10
+# match_tracked 在上次命中位置周围多搜的像素
+LAST_HIT_PAD = 60
+# main_loop 每帧按顺序匹配的模板组，和原来的优先级一致：先结算、商店，再看选项
+MAIN_LOOP_GROUPS = {
+    "battle": {"save": 0.8, "enter_shop": 0.8},
+    "dialog": {"select": 0.7, "choice": 0.8},
+}
+# wait_and_click 的轮询间隔：从 WAIT_POLL_MIN 开始按倍数退避到 WAIT_POLL_MAX
+WAIT_POLL_MIN = 0.1
+WAIT_POLL_MAX = 0.5
+WAIT_POLL_BACKOFF = 1.3
+# continuous_fast_click 每点几次检查一次窗口中央是否变化，以及判定“变化”的像素差和比例
+FAST_CLICK_CHECK_EVERY = 5
+FAST_CLICK_PIXEL_DIFF = 32
+FAST_CLICK_CHANGE_RATIO = 0.2
+# dismiss_popups 判断弹窗是否还在变化时用的比例：弹窗开关会改动缩略图的一大片，背景动画只动零星几个像素
+POPUP_CHANGE_RATIO = 0.05
+# 后台截图线程：两次截图的最小间隔，以及主线程能接受的最旧一帧
+CAPTURE_INTERVAL = 0.05
+MAX_FRAME_AGE = 0.2
+# 模拟器窗口句柄缓存后，每隔多久确认一次窗口还在
+WINDOW_RECHECK_INTERVAL = 1.0
+# bettercam / mss 连续失败这么多次就暂停使用 CAPTURE_RETRY_AFTER 秒（窗口位置变了会提前恢复），期间走后面的截图方式
+CAPTURE_MAX_FAILURES = 20
+CAPTURE_RETRY_AFTER = 10.0
+# 窗口位置和尺寸的缓存时长：截图、点击都要用，没必要每次都去问系统
+WINDOW_RECT_INTERVAL = 0.5
+
+# name: (文件名, 搜索区域)，搜索区域为窗口的 (y0, y1, x0, x1) 比例，None 表示全窗口
 TEMPLATES = {
-    "quick_start": "quick_start_button.png",
-    "next": "next.png",
-    "start_battle": "start_battle.png",
-    "choice": "choice.png",
-    "tag": "tag.png",
-    "note": "note.png",
-    "hundred": "100.png",
-    "buy": "buy.png",
-    "refresh": "refresh.png",
-    "back": "back.png",
-    "leave": "leave.png",
-    "save": "save.png",
-    "enter_shop": "enter_shop.png",
-    "not_enough_money": "not_enough_money.png",
-    "enter": "enter_button.png",
-    "confirm": "confirm.png",
-    "select": "select.png",
-    "select_confirm": "select_confirm.png",
-    "shop": "shop.png",
-    "strengthen": "strengthen.png",
-    "sold_out": "sold_out.png",
+    "quick_start": ("quick_start_button.png", None),
+    "next": ("next.png", None),
+    "start_battle": ("start_battle.png", None),
+    "choice": ("choice.png", None),
+    "tag": ("tag.png", None),
+    "note": ("note.png", None),
+    "hundred": ("100.png", None),
+    "buy": ("buy.png", None),
+    "refresh": ("refresh.png", None),
+    "back": ("back.png", (0.0, 0.15, 0.0, 0.2)),
+    "leave": ("leave.png", None),
+    "save": ("save.png", (0.3, 0.8, 0.2, 0.9)),
+    "enter_shop": ("enter_shop.png", None),
+    "not_enough_money": ("not_enough_money.png", None),
+    "enter": ("enter_button.png", None),
+    "confirm": ("confirm.png", None),
+    "select": ("select.png", None),
+    "select_confirm": ("select_confirm.png", None),
+    "shop": ("shop.png", None),
+    "strengthen": ("strengthen.png", None),
+    "sold_out": ("sold_out.png", None),
 }
 
-PAUSED = False
+def opencv_has_ipp() -> bool:
+    for line in cv2.getBuildInformation().splitlines():
+        key, _, value = line.strip().partition(":")
+        if key == "Intel IPP":
+            return not value.strip().upper().startswith("NO")
+    return False
+
+
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def rgb_to_gray_numba(rgb, out):
+        # 与 cv2 的 0.299/0.587/0.114 定点近似一致
+        for i in prange(rgb.shape[0]):
+            for j in range(rgb.shape[1]):
+                out[i, j] = (np.int32(rgb[i, j, 0]) * 77 + np.int32(rgb[i, j, 1]) * 150
+                             + np.int32(rgb[i, j, 2]) * 29) >> 8
+else:
+    rgb_to_gray_numba = None
+
+# 没有 IPP 加速的 OpenCV 上 cvtColor 比较慢，装了 numba 就用多核内核做灰度转换
+USE_NUMBA_GRAY = rgb_to_gray_numba is not None and not opencv_has_ipp()
+
+# 确保 OpenCV 的 SIMD/IPP 优化路径和内部多线程都打开（某些环境或第三方库会把它们关掉），线程数可用环境变量 CV_THREADS 指定
+cv2.setUseOptimized(True)
+cv2.setNumThreads(int(os.environ.get("CV_THREADS", os.cpu_count() or 1)))
+
+# 设置环境变量 USE_OCL=1 且有 OpenCL 设备时，整块区域的 matchTemplate 走 UMat（OCL 内核）；
+# 默认关闭：还没在真实 GPU 上测过，上传和 .get() 的开销可能比省下的计算还多
+USE_OCL = os.environ.get("USE_OCL", "0") == "1" and cv2.ocl.haveOpenCL()
+cv2.ocl.setUseOpenCL(USE_OCL)
+_UMAT_CACHE: dict[int, Tuple[np.ndarray, cv2.UMat]] = {}
+# 每个模板上一次命中的窗口内中心坐标，match_tracked 先在它附近找
+_LAST_HIT: dict[str, Tuple[int, int]] = {}
+
+_CACHED_WIN: Optional[gw.Win32Window] = None
+_WIN_CHECKED_AT = 0.0
+_WIN_RECT: Optional[Tuple[int, int, int, int]] = None
+_RECT_CHECKED_AT = 0.0
+_CAMERA = None
+_CAMERA_FAILED = False
+_LAST_GRAB: Optional[Tuple[Tuple[int, int, int, int], np.ndarray]] = None
+# mss 实例持有的 DC 句柄不能跨线程使用（后台截图线程每轮运行都会新建），每个线程各建一个
+_SCT_LOCAL = threading.local()
+_SCT_FAILED = False
+# 各截图后端当前连续失败的次数
+_GRAB_FAILURES: dict[str, int] = {}
+# 暂停中的截图后端：恢复时间和失败时的截图区域
+_GRAB_PAUSED: dict[str, Tuple[float, Tuple[int, int, int, int]]] = {}
+_DIB_LOCAL = threading.local()
+_DIB_FAILED = False
+_CAPTURE_BUF: Optional[np.ndarray] = None
+# cv2.matchTemplate 会释放 GIL，同一帧上的多个模板可以并行匹配
+_MATCH_POOL = ThreadPoolExecutor(max_workers=min(4, os.cpu_count() or 1))
+# matchTemplate 结果图按 (用途, 形状) 复用；匹配会在线程池里并发，所以每个线程一份
+_RESULT_POOL = threading.local()
+
+INPUT_MOUSE = 0
+MOUSEEVENTF_LEFTDOWN = 0x0002
+MOUSEEVENTF_LEFTUP = 0x0004
+
+
+class MOUSEINPUT(ctypes.Structure):
+    _fields_ = [
+        ("dx", ctypes.c_long),
+        ("dy", ctypes.c_long),
+        ("mouseData", ctypes.c_ulong),
+        ("dwFlags", ctypes.c_ulong),
+        ("time", ctypes.c_ulong),
+        ("dwExtraInfo", ctypes.c_size_t),
+    ]
+
+
+class INPUT(ctypes.Structure):
+    class _INPUT(ctypes.Union):
+        _fields_ = [("mi", MOUSEINPUT)]
+
+    _anonymous_ = ("_input",)
+    _fields_ = [("type", ctypes.c_ulong), ("_input", _INPUT)]
+
+
+SRCCOPY = 0x00CC0020
+CAPTUREBLT = 0x40000000
+DIB_RGB_COLORS = 0
+BI_RGB = 0
+
+
+class BITMAPINFOHEADER(ctypes.Structure):
+    _fields_ = [
+        ("biSize", ctypes.c_uint32),
+        ("biWidth", ctypes.c_int32),
+        ("biHeight", ctypes.c_int32),
+        ("biPlanes", ctypes.c_uint16),
+        ("biBitCount", ctypes.c_uint16),
+        ("biCompression", ctypes.c_uint32),
+        ("biSizeImage", ctypes.c_uint32),
+        ("biXPelsPerMeter", ctypes.c_int32),
+        ("biYPelsPerMeter", ctypes.c_int32),
+        ("biClrUsed", ctypes.c_uint32),
+        ("biClrImportant", ctypes.c_uint32),
+    ]
+
+
+if _GDI32 is not None:
+    # 句柄在 64 位下是指针宽度，默认的 c_int 返回值会被截断
+    _USER32.GetDC.restype = ctypes.c_void_p
+    _USER32.GetDC.argtypes = [ctypes.c_void_p]
+    _USER32.ReleaseDC.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+    _GDI32.CreateCompatibleDC.restype = ctypes.c_void_p
+    _GDI32.CreateCompatibleDC.argtypes = [ctypes.c_void_p]
+    _GDI32.CreateDIBSection.restype = ctypes.c_void_p
+    _GDI32.CreateDIBSection.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_uint,
+                                        ctypes.POINTER(ctypes.c_void_p), ctypes.c_void_p, ctypes.c_uint32]
+    _GDI32.SelectObject.restype = ctypes.c_void_p
+    _GDI32.SelectObject.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+    _GDI32.BitBlt.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_int,
+                              ctypes.c_void_p, ctypes.c_int, ctypes.c_int, ctypes.c_uint32]
+    _GDI32.DeleteObject.argtypes = [ctypes.c_void_p]
+    _GDI32.DeleteDC.argtypes = [ctypes.c_void_p]
+
+
+def make_click_inputs() -> ctypes.Array:
+    # 一次左键按下 + 抬起
+    inputs = (INPUT * 2)()
+    inputs[0].type = inputs[1].type = INPUT_MOUSE
+    inputs[0].mi.dwFlags = MOUSEEVENTF_LEFTDOWN
+    inputs[1].mi.dwFlags = MOUSEEVENTF_LEFTUP
+    return inputs
+
+
+_CLICK_INPUTS = make_click_inputs()
+# 最近一次点击的时间，点击之前截到的帧已经过时
+_LAST_INPUT_TIME = 0.0
+_GRABBER = None
+
+# set 表示运行中，clear 表示暂停；等待方直接阻塞在 wait() 上，不再轮询
+_PAUSE_EVENT = threading.Event()
+_PAUSE_EVENT.set()
 SKIP_INITIAL_WAIT = False
 RUNNING = True
 
 
 def toggle_pause():
-    global PAUSED
-    PAUSED = not PAUSED
-    if PAUSED:
+    if _PAUSE_EVENT.is_set():
+        _PAUSE_EVENT.clear()
         print("[Hotkey] Paused")
     else:
+        _PAUSE_EVENT.set()
         print("[Hotkey] Resumed")
 
 
@@ -61,153 +272,859 @@ def mark_skip_initial():
 def stop_running():
     global RUNNING
     RUNNING = False
+    # 唤醒暂停中的等待方，让它们看到停止请求
+    _PAUSE_EVENT.set()
     print("[Hotkey] Stop requested")
 
 
 def check_pause_and_running():
-    global RUNNING
     if not RUNNING:
         raise KeyboardInterrupt("User requested stop")
-    while PAUSED and RUNNING:
-        time.sleep(0.1)
+    if _PAUSE_EVENT.is_set():
+        return
+    _PAUSE_EVENT.wait()
     if not RUNNING:
         raise KeyboardInterrupt("User requested stop")
 
 
-def load_template(name: str) -> Optional[np.ndarray]:
-    filename = TEMPLATES.get(name)
-    if not filename:
+def click_at(x: int, y: int):
+    # 直接 SetCursorPos + SendInput，省掉 pyautogui 每次点击的校验和移动开销；非 Windows 或调用失败时退回 pyautogui
+    global _LAST_INPUT_TIME
+    if _USER32 is not None and _USER32.SetCursorPos(int(x), int(y)) and send_clicks(_CLICK_INPUTS):
+        return
+    pyautogui.click(x, y)
+    _LAST_INPUT_TIME = time.monotonic()
+
+
+def send_clicks(inputs: ctypes.Array) -> bool:
+    # 在当前光标位置发送预先构造好的按下/抬起序列，一次系统调用
+    global _LAST_INPUT_TIME
+    if _USER32 is None or _USER32.SendInput(len(inputs), inputs, ctypes.sizeof(INPUT)) != len(inputs):
+        return False
+    _LAST_INPUT_TIME = time.monotonic()
+    return True
+
+
+@dataclass(frozen=True)
+class TemplateEntry:
+    # 一个模板匹配时用到的全部数据：图像、金字塔最粗一层的图像及层数、尺寸和搜索区域
+    name: str
+    image: np.ndarray
+    small: Optional[np.ndarray]
+    level: int
+    h: int
+    w: int
+    # 匹配结果左上角到模板中心的偏移
+    half_h: int
+    half_w: int
+    roi: Optional[Tuple[float, float, float, float]]
+
+
+@functools.lru_cache(maxsize=None)
+def load_template_image(name: str, gray: Optional[bool] = None) -> Optional[np.ndarray]:
+    # 模板只解码一次，返回的数组在各处共享，调用方不要原地修改；默认按 MATCH_GRAYSCALE 返回灰度或 RGB
+    if gray is None:
+        gray = MATCH_GRAYSCALE
+    if gray:
+        template = load_template_image(name, gray=False)
+        if template is None:
+            return None
+        if GRAY_FROM_GREEN:
+            return cv2.extractChannel(template, 1)
+        return cv2.cvtColor(template, cv2.COLOR_RGB2GRAY)
+    if name not in TEMPLATES:
         return None
+    filename, _ = TEMPLATES[name]
     path = os.path.join(RESOURCE_DIR, filename)
     if not os.path.isfile(path):
         return None
     template = cv2.imread(path, cv2.IMREAD_COLOR)
     if template is None or template.size == 0:
         return None
-    return template
+    # 彩色模板按 RGB 存，和截图的通道顺序一致，截图就不用再转 BGR
+    return cv2.cvtColor(template, cv2.COLOR_BGR2RGB, dst=template)
+
+
+def load_template(name: str, gray: Optional[bool] = None) -> Optional[TemplateEntry]:
+    return template_entry(name, MATCH_GRAYSCALE if gray is None else gray)
+
+
+@functools.lru_cache(maxsize=None)
+def template_entry(name: str, gray: bool) -> Optional[TemplateEntry]:
+    image = load_template_image(name, gray)
+    if image is None:
+        return None
+    h, w = image.shape[:2]
+    level = 0
+    while (level < PYRAMID_LEVELS and min(h, w) >= PYRAMID_MIN_TEMPLATE << level
+           and phase_score(image, level + 1) >= PYRAMID_PHASE_SCORE):
+        level += 1
+    small = pyr_down(image, level) if level else None
+    return TemplateEntry(name, image, small, level, h, w, h // 2, w // 2, TEMPLATES[name][1])
+
+
+def phase_score(image: np.ndarray, level: int) -> float:
+    # 模板放在暗/中/亮三种纯色背景上，遍历 level 层对应的全部像素相位，返回下采样后自匹配的最差得分
+    small = pyr_down(image, level)
+    h, w = image.shape[:2]
+    step = 1 << level
+    pad = 2 * step
+    worst = 1.0
+    for background in (30, 128, 220):
+        for dy in range(step):
+            for dx in range(step):
+                canvas = np.full((h + 2 * pad, w + 2 * pad) + image.shape[2:], background, np.uint8)
+                canvas[pad + dy:pad + dy + h, pad + dx:pad + dx + w] = image
+                result = cv2.matchTemplate(pyr_down(canvas, level), small, cv2.TM_CCOEFF_NORMED)
+                worst = min(worst, float(result.max()))
+    return worst
+
+
+def pyr_down(img: np.ndarray, levels: int) -> np.ndarray:
+    for _ in range(levels):
+        img = cv2.pyrDown(img)
+    return img
+
+
+def preload_templates() -> list[str]:
+    # 启动时把所有模板（以及金字塔用的下采样版本）解码一遍，顺便报告缺失的模板
+    return [name for name in TEMPLATES if load_template(name) is None]
+
+
+def is_emulator_title(title: str) -> bool:
+    title = title.lower()
+    return "mumu" in title or "模拟器" in title
 
 
 def get_emulator_window() -> Optional[gw.Win32Window]:
     for window in gw.getAllWindows():
-        title = window.title.lower()
-        if "mumu" in title or "模拟器" in title:
+        if is_emulator_title(window.title):
             return window
     return None
 
 
-def capture_emulator() -> Tuple[np.ndarray, Tuple[int, int, int, int]]:
-    check_pause_and_running()
-    win = get_emulator_window()
-    if not win:
-        raise RuntimeError("MuMu window not found. Ensure the emulator is running.")
-    left, top, width, height = win.left, win.top, win.width, win.height
+def get_cached_window() -> Optional[gw.Win32Window]:
+    # 枚举所有窗口很慢，找到一次之后复用句柄，只定期检查它是否还可见；没找到时同样隔一段时间才重新枚举
+    global _CACHED_WIN, _WIN_CHECKED_AT
+    now = time.monotonic()
+    if now - _WIN_CHECKED_AT < WINDOW_RECHECK_INTERVAL:
+        return _CACHED_WIN
+    _WIN_CHECKED_AT = now
+    if _CACHED_WIN is not None:
+        try:
+            # 句柄可能被系统回收后分给了别的窗口，标题也要还对得上
+            if not _CACHED_WIN.visible or not is_emulator_title(_CACHED_WIN.title):
+                _CACHED_WIN = None
+        except Exception:
+            _CACHED_WIN = None
+    if _CACHED_WIN is None:
+        _CACHED_WIN = get_emulator_window()
+    return _CACHED_WIN
+
+
+def invalidate_window():
+    # 句柄失效时下一次调用立即重新枚举
+    global _CACHED_WIN, _WIN_CHECKED_AT, _WIN_RECT
+    _CACHED_WIN = None
+    _WIN_CHECKED_AT = 0.0
+    _WIN_RECT = None
+
+
+def get_window_rect() -> Tuple[int, int, int, int]:
+    # 窗口位置在 WINDOW_RECT_INTERVAL 内直接复用；读取时用 box 一次 GetWindowRect 拿全四个值
+    global _WIN_RECT, _RECT_CHECKED_AT
+    now = time.monotonic()
+    if _WIN_RECT is not None and now - _RECT_CHECKED_AT < WINDOW_RECT_INTERVAL:
+        return _WIN_RECT
+    for attempt in range(2):
+        win = get_cached_window()
+        if not win:
+            raise RuntimeError("MuMu window not found. Ensure the emulator is running.")
+        try:
+            left, top, width, height = win.box
+            if width <= 0 or height <= 0:
+                win.restore()
+                time.sleep(0.5)
+                left, top, width, height = win.box
+            if width > 0 and height > 0:
+                _WIN_RECT, _RECT_CHECKED_AT = (left, top, width, height), time.monotonic()
+            return left, top, width, height
+        except Exception:
+            # 句柄失效（模拟器重启等），重新枚举一次
+            if attempt:
+                raise
+            invalidate_window()
+
+
+def get_camera():
+    global _CAMERA, _CAMERA_FAILED
+    if _CAMERA is None and bettercam is not None and not _CAMERA_FAILED:
+        try:
+            _CAMERA = bettercam.create(output_color="GRAY" if MATCH_GRAYSCALE and not GRAY_FROM_GREEN else "RGB")
+        except Exception as e:
+            _CAMERA_FAILED = True
+            print(f"[Capture] bettercam unavailable, fallback to pyautogui: {e}")
+    return _CAMERA
+
+
+def grab_failed(backend: str, error: Exception, region: Tuple[int, int, int, int]) -> bool:
+    # 连续失败只在第一次打印（截图线程一秒要截 20 次）；连续 CAPTURE_MAX_FAILURES 次都失败时暂停该后端并返回 True
+    count = _GRAB_FAILURES.get(backend, 0) + 1
+    _GRAB_FAILURES[backend] = count
+    if count == 1:
+        print(f"[Capture] {backend} grab failed: {error}")
+    if count < CAPTURE_MAX_FAILURES:
+        return False
+    print(f"[Capture] {backend} failed {count} times in a row, paused for {CAPTURE_RETRY_AFTER:.0f}s")
+    _GRAB_FAILURES[backend] = 0
+    _GRAB_PAUSED[backend] = (time.monotonic() + CAPTURE_RETRY_AFTER, region)
+    return True
+
+
+def grab_paused(backend: str, region: Tuple[int, int, int, int]) -> bool:
+    # 暂停到期，或者窗口移动/缩放过（失败原因可能已经消失）时恢复
+    paused = _GRAB_PAUSED.get(backend)
+    if paused is None:
+        return False
+    until, failed_region = paused
+    if time.monotonic() < until and region == failed_region:
+        return True
+    del _GRAB_PAUSED[backend]
+    return False
+
+
+def grab_with_camera(left: int, top: int, width: int, height: int) -> Optional[np.ndarray]:
+    global _LAST_GRAB, _CAMERA
+    region = (left, top, left + width, top + height)
+    if grab_paused("bettercam", region):
+        return None
+    camera = get_camera()
+    if camera is None:
+        return None
+    try:
+        frame = camera.grab(region=region)
+    except Exception as e:
+        # 窗口跨出主显示器等情况 bettercam 会报错，这一帧退回后面的截图方式；一直失败就释放掉，恢复时重新创建
+        if grab_failed("bettercam", e, region):
+            try:
+                camera.release()
+            except Exception:
+                pass
+            _CAMERA = None
+        return None
+    _GRAB_FAILURES["bettercam"] = 0
+    if frame is None:
+        # 画面没有变化时 bettercam 不返回新帧，沿用同一区域的上一帧
+        if _LAST_GRAB is not None and _LAST_GRAB[0] == region:
+            return _LAST_GRAB[1]
+        return None
+    if frame.ndim == 3 and frame.shape[2] == 1:
+        frame = frame.reshape(frame.shape[:2])
+    elif MATCH_GRAYSCALE and GRAY_FROM_GREEN:
+        frame = cv2.extractChannel(frame, 1)
+    _LAST_GRAB = (region, frame)
+    return frame
+
+
+def grab_with_mss(left: int, top: int, width: int, height: int) -> Optional[np.ndarray]:
+    # mss 直接 BitBlt 出 BGRA，比 pyautogui 经过 PIL 少几次拷贝；实例复用，避免每帧重新拿 DC
+    global _SCT_FAILED
+    if mss is None or _SCT_FAILED:
+        return None
+    sct = getattr(_SCT_LOCAL, "sct", None)
+    if sct is None:
+        try:
+            sct = _SCT_LOCAL.sct = mss.mss()
+        except Exception as e:
+            _SCT_FAILED = True
+            print(f"[Capture] mss unavailable, fallback to pyautogui: {e}")
+            return None
+    region = (left, top, width, height)
+    if grab_paused("mss", region):
+        return None
+    try:
+        raw = sct.grab({"left": left, "top": top, "width": width, "height": height})
+    except Exception as e:
+        grab_failed("mss", e, region)
+        return None
+    _GRAB_FAILURES["mss"] = 0
+    bgra = np.frombuffer(raw.bgra, np.uint8).reshape(raw.height, raw.width, 4)
+    if not MATCH_GRAYSCALE:
+        return cv2.cvtColor(bgra, cv2.COLOR_BGRA2RGB, dst=capture_buffer(bgra.shape[:2] + (3,)))
+    return frame_to_gray(bgra, cv2.COLOR_BGRA2GRAY)
+
+
+class DibCapture:
+    # 屏幕 DC 一次 BitBlt 进预先建好的 DIB，像素直接映射成 numpy 数组，不经过 GetDIBits 和 PIL 的拷贝
+    def __init__(self, width: int, height: int):
+        self.width, self.height = width, height
+        self.screen_dc = _USER32.GetDC(None)
+        self.mem_dc = _GDI32.CreateCompatibleDC(self.screen_dc)
+        header = BITMAPINFOHEADER(biSize=ctypes.sizeof(BITMAPINFOHEADER), biWidth=width, biHeight=-height,
+                                  biPlanes=1, biBitCount=32, biCompression=BI_RGB)
+        bits = ctypes.c_void_p()
+        self.bitmap = _GDI32.CreateDIBSection(self.mem_dc, ctypes.byref(header), DIB_RGB_COLORS,
+                                              ctypes.byref(bits), None, 0)
+        if not self.bitmap or not bits.value:
+            self.close()
+            raise OSError("CreateDIBSection failed")
+        self.old_bitmap = _GDI32.SelectObject(self.mem_dc, self.bitmap)
+        # biHeight 为负表示自上而下的行序，和 numpy 的行顺序一致
+        buffer = (ctypes.c_ubyte * (width * height * 4)).from_address(bits.value)
+        self.bgra = np.ctypeslib.as_array(buffer).reshape(height, width, 4)
+
+    def grab(self, left: int, top: int) -> Optional[np.ndarray]:
+        # 返回的数组就是 DIB 本身，下一次 grab 会覆盖
+        if not _GDI32.BitBlt(self.mem_dc, 0, 0, self.width, self.height, self.screen_dc, left, top,
+                             SRCCOPY | CAPTUREBLT):
+            return None
+        _GDI32.GdiFlush()
+        return self.bgra
+
+    def close(self):
+        if getattr(self, "old_bitmap", None):
+            _GDI32.SelectObject(self.mem_dc, self.old_bitmap)
+        if self.bitmap:
+            _GDI32.DeleteObject(self.bitmap)
+        if self.mem_dc:
+            _GDI32.DeleteDC(self.mem_dc)
+        if self.screen_dc:
+            _USER32.ReleaseDC(None, self.screen_dc)
+        self.old_bitmap = self.bitmap = self.mem_dc = self.screen_dc = None
+
+
+def release_thread_capture():
+    # 截图线程退出前释放本线程的 DIB 和 mss 实例，否则每跑一轮新建一个截图线程就漏一套 DC 和整窗口大小的位图
+    capture = getattr(_DIB_LOCAL, "capture", None)
+    if capture is not None:
+        capture.close()
+        _DIB_LOCAL.capture = None
+    sct = getattr(_SCT_LOCAL, "sct", None)
+    if sct is not None:
+        try:
+            sct.close()
+        except Exception:
+            pass
+        _SCT_LOCAL.sct = None
+
+
+def grab_with_dib(left: int, top: int, width: int, height: int) -> Optional[np.ndarray]:
+    # GDI 句柄和线程绑定，每个截图线程各有一个 DibCapture；窗口尺寸变化时重建
+    global _DIB_FAILED
+    if _GDI32 is None or _DIB_FAILED:
+        return None
     if width <= 0 or height <= 0:
-        win.restore()
-        time.sleep(0.5)
-        left, top, width, height = win.left, win.top, win.width, win.height
-    screenshot = pyautogui.screenshot(region=(left, top, width, height))
-    img = cv2.cvtColor(np.array(screenshot), cv2.COLOR_RGB2BGR)
+        # 窗口最小化或 restore() 还没生效，这一帧跳过；不能当成 GDI 不可用
+        return None
+    capture = getattr(_DIB_LOCAL, "capture", None)
+    if capture is not None and (capture.width, capture.height) != (width, height):
+        capture.close()
+        capture = _DIB_LOCAL.capture = None
+    if capture is None:
+        try:
+            capture = _DIB_LOCAL.capture = DibCapture(width, height)
+        except Exception as e:
+            _DIB_FAILED = True
+            print(f"[Capture] GDI capture unavailable, fallback to mss/pyautogui: {e}")
+            return None
+    bgra = capture.grab(left, top)
+    if bgra is None:
+        return None
+    if not MATCH_GRAYSCALE:
+        return cv2.cvtColor(bgra, cv2.COLOR_BGRA2RGB, dst=capture_buffer(bgra.shape[:2] + (3,)))
+    return frame_to_gray(bgra, cv2.COLOR_BGRA2GRAY)
+
+
+def frame_to_gray(frame: np.ndarray, code: int) -> np.ndarray:
+    # 转到复用的截图缓冲区；GRAY_FROM_GREEN 时只取绿色通道（RGB 和 BGRA 里都是第 1 个通道）
+    dst = capture_buffer(frame.shape[:2])
+    if GRAY_FROM_GREEN:
+        return cv2.extractChannel(frame, 1, dst=dst)
+    return cv2.cvtColor(frame, code, dst=dst)
+
+
+def capture_buffer(shape: Tuple[int, ...]) -> np.ndarray:
+    # 截图转换的输出缓冲区，窗口尺寸不变就一直复用，避免每帧分配一整张图
+    global _CAPTURE_BUF
+    if _CAPTURE_BUF is None or _CAPTURE_BUF.shape != shape:
+        _CAPTURE_BUF = np.empty(shape, np.uint8)
+    return _CAPTURE_BUF
+
+
+@dataclass(eq=False)
+class Frame:
+    # 一次截图：图像、窗口位置，以及金字塔匹配共用的各层下采样图像（用到哪层才算到哪层）
+    image: np.ndarray
+    rect: Tuple[int, int, int, int]
+    # scan_all 的结果缓存：(模板名, 阈值, 匹配函数) -> 结果，帧丢弃时一起失效
+    matches: dict = field(default_factory=dict, repr=False)
+    levels: list = field(default_factory=list, repr=False)
+
+    def pyramid(self, depth: int) -> list[np.ndarray]:
+        # [原图, 1/2, 1/4, ...]，至少算到第 depth 层
+        if not self.levels:
+            self.levels.append(self.image)
+        while len(self.levels) <= depth:
+            self.levels.append(cv2.pyrDown(self.levels[-1]))
+        return self.levels
+
+    def __iter__(self):
+        # 兼容 img, rect = capture_emulator() 的写法
+        return iter((self.image, self.rect))
+
+
+def capture_emulator() -> Frame:
+    # 返回的图像复用同一块缓冲区，只在下一次调用前有效，需要保留请自行 copy()
+    check_pause_and_running()
+    if _GRABBER is not None and _GRABBER.is_alive():
+        return Frame(*_GRABBER.latest())
+    return Frame(*grab_frame())
+
+
+def grab_frame() -> Tuple[np.ndarray, Tuple[int, int, int, int]]:
+    left, top, width, height = get_window_rect()
+    img = grab_with_camera(left, top, width, height)
+    if img is None:
+        img = grab_with_dib(left, top, width, height)
+    if img is None:
+        img = grab_with_mss(left, top, width, height)
+    if img is None:
+        screenshot = pyautogui.screenshot(region=(left, top, width, height))
+        if not MATCH_GRAYSCALE:
+            # 模板也是 RGB，直接拿截图去匹配
+            return np.asarray(screenshot), (left, top, width, height)
+        rgb = np.asarray(screenshot)
+        if USE_NUMBA_GRAY and not GRAY_FROM_GREEN:
+            img = capture_buffer(rgb.shape[:2])
+            rgb_to_gray_numba(rgb, img)
+        else:
+            img = frame_to_gray(rgb, cv2.COLOR_RGB2GRAY)
     return img, (left, top, width, height)
 
 
-def match_template(src: np.ndarray, template: np.ndarray, threshold: float = IMAGE_MATCH_THRESHOLD) -> Optional[
-    Tuple[int, int]]:
+class FrameGrabber:
+    # 后台线程不停截图，主线程取最新一帧去匹配，截图和匹配可以重叠进行
+    def __init__(self):
+        self._queue: queue.Queue = queue.Queue(maxsize=1)
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="frame-grabber", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=2.0)
+
+    def is_alive(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def _run(self):
+        try:
+            self._loop()
+        finally:
+            release_thread_capture()
+
+    def _loop(self):
+        while not self._stop.is_set():
+            if not _PAUSE_EVENT.is_set():
+                # 带超时等待，暂停期间 stop() 仍能及时退出
+                _PAUSE_EVENT.wait(0.5)
+                continue
+            started = time.monotonic()
+            try:
+                img, rect = grab_frame()
+                # grab_frame 复用缓冲区，交给主线程的帧必须是独立的一份
+                item = (started, time.monotonic(), img.copy(), rect, None)
+            except Exception as e:
+                item = (started, time.monotonic(), None, None, e)
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                pass
+            self._queue.put_nowait(item)
+            self._stop.wait(max(0.0, CAPTURE_INTERVAL - (time.monotonic() - started)))
+
+    def latest(self) -> Tuple[np.ndarray, Tuple[int, int, int, int]]:
+        # 只接受最近一次点击之后才开始截的帧；帧龄从截完算起，截一帧超过 MAX_FRAME_AGE 的慢后端（pyautogui）只会变慢，不会一直等不到帧
+        while True:
+            check_pause_and_running()
+            try:
+                started, finished, img, rect, error = self._queue.get(timeout=1.0)
+            except queue.Empty:
+                if not self.is_alive():
+                    return grab_frame()
+                continue
+            if started < _LAST_INPUT_TIME or finished < time.monotonic() - MAX_FRAME_AGE:
+                continue
+            if error is not None:
+                raise error
+            return img, rect
+
+
+def start_frame_grabber():
+    global _GRABBER
+    if _GRABBER is None or not _GRABBER.is_alive():
+        _GRABBER = FrameGrabber()
+        _GRABBER.start()
+
+
+def stop_frame_grabber():
+    global _GRABBER
+    if _GRABBER is not None:
+        _GRABBER.stop()
+        _GRABBER = None
+
+
+def crop_roi(src: np.ndarray, roi: Optional[Tuple[float, float, float, float]]) -> Tuple[np.ndarray, int, int]:
+    if roi is None:
+        return src, 0, 0
+    h, w = src.shape[:2]
+    y0, y1, x0, x1 = roi
+    top, left = int(y0 * h), int(x0 * w)
+    return src[top:int(y1 * h), left:int(x1 * w)], left, top
+
+
+def get_template_umat(template: np.ndarray) -> cv2.UMat:
+    cached = _UMAT_CACHE.get(id(template))
+    if cached is None or cached[0] is not template:
+        cached = (template, cv2.UMat(template))
+        _UMAT_CACHE[id(template)] = cached
+    return cached[1]
+
+
+def run_match(src: np.ndarray, template: np.ndarray, tag: str = "full") -> np.ndarray:
+    # 返回的结果图会被同一线程下一次同 tag、同尺寸的匹配覆盖
+    # 粗匹配、精修、附近确认这些小窗口算得很快，上传到 GPU 不划算，只有整块区域才走 OpenCL
+    if USE_OCL and tag == "full":
+        return cv2.matchTemplate(cv2.UMat(np.ascontiguousarray(src)), get_template_umat(template),
+                                 cv2.TM_CCOEFF_NORMED).get()
+    t_h, t_w = template.shape[:2]
+    key = (tag, src.shape[0] - t_h + 1, src.shape[1] - t_w + 1)
+    pool = getattr(_RESULT_POOL, "buffers", None)
+    if pool is None:
+        pool = _RESULT_POOL.buffers = {}
+    result = pool.get(key)
+    if result is None:
+        result = pool[key] = np.empty(key[1:], np.float32)
+    return cv2.matchTemplate(src, template, cv2.TM_CCOEFF_NORMED, result=result)
+
+
+def result_peak(result: np.ndarray, threshold: float) -> Optional[Tuple[float, Tuple[int, int]]]:
+    # 轮询时绝大多数帧都不命中，先用 max() 做一次归约判断，命中后才去找位置
+    max_val = float(result.max())
+    if max_val < threshold:
+        return None
+    y, x = np.unravel_index(int(result.argmax()), result.shape)
+    return max_val, (int(x), int(y))
+
+
+def match_template(src: np.ndarray, template: TemplateEntry, threshold: float = IMAGE_MATCH_THRESHOLD,
+                   roi: Optional[Tuple[float, float, float, float]] = None,
+                   pyramid: Optional[list[np.ndarray]] = None) -> Optional[Tuple[int, int]]:
+    # roi 缺省用模板自带的搜索区域；pyramid 为整帧的各层下采样（Frame.pyramid），传入后金字塔匹配不再各自下采样
     if src is None or template is None:
         return None
-    result = cv2.matchTemplate(src, template, cv2.TM_CCOEFF_NORMED)
-    _, max_val, _, max_loc = cv2.minMaxLoc(result)
-    if max_val < threshold:
+    roi = roi or template.roi
+    src, off_x, off_y = crop_roi(src, roi)
+    if cannot_match(src, template):
         return None
-    t_h, t_w = template.shape[:2]
-    x, y = max_loc
-    center_x = x + t_w // 2
-    center_y = y + t_h // 2
+    if template.small is not None:
+        coarse_src = None
+        if pyramid is not None and len(pyramid) > template.level:
+            coarse_src = coarse_view(pyramid[template.level], template.level, roi, off_x, off_y)
+        pos = match_template_pyramid(src, template, threshold, coarse_src)
+        if pos is None:
+            return None
+        return off_x + pos[0], off_y + pos[1]
+    result = run_match(src, template.image)
+    peak = result_peak(result, threshold)
+    if peak is None:
+        return None
+    x, y = peak[1]
+    center_x = off_x + x + template.half_w
+    center_y = off_y + y + template.half_h
     return center_x, center_y
 
 
+def cannot_match(src: np.ndarray, template: TemplateEntry) -> bool:
+    # 搜索区域比模板还小（窗口最小化、区域裁得太小）时 matchTemplate 会直接报错；
+    # 整块纯色（加载黑屏）时 NCC 处处为 0，也不用再算。只看最大最小值是否相等：
+    # 用整块的标准差判断会把大片纯色背景上的小图标（tag）也当成纯色跳过
+    if src.shape[0] < template.h or src.shape[1] < template.w:
+        return True
+    return int(src.max()) == int(src.min())
+
+
+def coarse_view(small: np.ndarray, level: int, roi: Optional[Tuple[float, float, float, float]],
+                off_x: int, off_y: int) -> Tuple[np.ndarray, int, int]:
+    # 从整帧的下采样图像里裁出同一搜索区域，并给出坐标放大回原尺寸后相对原图裁剪区域的偏移（差几个像素，精匹配会修正）
+    view, left, top = crop_roi(small, roi)
+    return view, (left << level) - off_x, (top << level) - off_y
+
+
+def match_template_pyramid(src: np.ndarray, template: TemplateEntry, threshold: float,
+                           coarse_src: Optional[Tuple[np.ndarray, int, int]] = None) -> Optional[Tuple[int, int]]:
+    t_h, t_w = template.h, template.w
+    s_h, s_w = template.small.shape[:2]
+    level = template.level
+    small_src, dx, dy = coarse_src or (None, 0, 0)
+    if small_src is None or small_src.shape[0] < s_h or small_src.shape[1] < s_w:
+        # 共享的下采样裁剪可能因取整比模板小一个像素，这时退回自己下采样
+        small_src, dx, dy = pyr_down(src, level), 0, 0
+    coarse = run_match(small_src, template.small, tag="coarse")
+    # 下采样后细笔画文字的得分受像素相位影响很大，粗筛门槛放低，取前几个峰回原图确认
+    best_val, best_pos = threshold, None
+    for _ in range(PYRAMID_CANDIDATES):
+        coarse_peak = result_peak(coarse, threshold * PYRAMID_COARSE_RATIO)
+        if coarse_peak is None:
+            break
+        cx, cy = coarse_peak[1]
+        coarse[max(0, cy - s_h // 2):cy + s_h // 2 + 1, max(0, cx - s_w // 2):cx + s_w // 2 + 1] = -1
+        off_x = max(0, (cx << level) + dx - PYRAMID_PAD)
+        off_y = max(0, (cy << level) + dy - PYRAMID_PAD)
+        roi = src[off_y:off_y + t_h + 2 * PYRAMID_PAD, off_x:off_x + t_w + 2 * PYRAMID_PAD]
+        if roi.shape[0] < t_h or roi.shape[1] < t_w:
+            continue
+        result = run_match(roi, template.image, tag="refine")
+        peak = result_peak(result, best_val)
+        if peak is not None:
+            best_val, (x, y) = peak
+            best_pos = (off_x + x + template.half_w, off_y + y + template.half_h)
+    return best_pos
+
+
+def match_near(img: np.ndarray, template: TemplateEntry, x: int, y: int, threshold: float, pad: int = 12) -> bool:
+    # 只在已知中心点附近做一次小范围匹配，确认图标还在原位
+    if img is None or template is None:
+        return False
+    t_h, t_w = template.h, template.w
+    left, top = max(0, x - template.half_w - pad), max(0, y - template.half_h - pad)
+    roi = img[top:y + template.half_h + pad + 1, left:x + template.half_w + pad + 1]
+    if roi.shape[0] < t_h or roi.shape[1] < t_w:
+        return False
+    return result_peak(run_match(roi, template.image, tag="near"), threshold) is not None
+
+
+def match_tracked(img: np.ndarray, template: TemplateEntry,
+                  threshold: float = IMAGE_MATCH_THRESHOLD) -> Optional[Tuple[int, int]]:
+    # 按钮和弹窗每次出现的位置几乎不变：先只在上次命中位置 ±LAST_HIT_PAD 的小块里匹配，没命中再用 match_template 搜整个区域
+    if img is None or template is None:
+        return None
+    last = _LAST_HIT.get(template.name)
+    if last is not None:
+        x, y = last
+        left = max(0, x - template.half_w - LAST_HIT_PAD)
+        top = max(0, y - template.half_h - LAST_HIT_PAD)
+        roi = img[top:y + template.h - template.half_h + LAST_HIT_PAD, left:x + template.w - template.half_w + LAST_HIT_PAD]
+        if roi.shape[0] >= template.h and roi.shape[1] >= template.w:
+            result = run_match(roi, template.image, tag="tracked")
+            peak = result_peak(result, threshold)
+            # 峰落在结果图边上说明目标可能在小窗口外、只被截到一部分，位置不可信，交给整块搜索
+            if peak is not None and 0 < peak[1][0] < result.shape[1] - 1 and 0 < peak[1][1] < result.shape[0] - 1:
+                px, py = peak[1]
+                pos = (left + px + template.half_w, top + py + template.half_h)
+                _LAST_HIT[template.name] = pos
+                return pos
+    pos = match_template(img, template, threshold)
+    if pos is not None:
+        _LAST_HIT[template.name] = pos
+    return pos
+
+
+def match_many(img: np.ndarray, candidates: dict[str, tuple], func=None, **kwargs) -> dict:
+    # candidates: {name: (TemplateEntry, threshold[, roi])}，默认用 match_template，也可以传 find_all_matches
+    func = func or match_template
+    futures = {name: _MATCH_POOL.submit(func, img, *args, **kwargs) for name, args in candidates.items()}
+    return {name: future.result() for name, future in futures.items()}
+
+
+def scan_all(frame: Frame, names: dict[str, float], func=None) -> dict:
+    # names: {模板名: 阈值}，同一帧上按模板名批量匹配，模板和搜索区域都取自缓存的 TemplateEntry
+    # 同一帧上已经用相同阈值匹配过的模板直接取 frame.matches 里的结果
+    candidates = {name: (load_template(name), threshold) for name, threshold in names.items()
+                  if (name, threshold, func) not in frame.matches}
+    if candidates:
+        kwargs = {}
+        depth = max((c[0].level for c in candidates.values() if c[0] is not None), default=0)
+        if func is None and depth:
+            # 有模板要走金字塔时先在主线程把整帧下采样到需要的层数，各模板共用
+            kwargs["pyramid"] = frame.pyramid(depth)
+        for name, pos in match_many(frame.image, candidates, func=func, **kwargs).items():
+            frame.matches[(name, names[name], func)] = pos
+    return {name: frame.matches[(name, threshold, func)] for name, threshold in names.items()}
+
+
+def thumbnail(img: np.ndarray) -> np.ndarray:
+    return cv2.resize(img, (32, 32), interpolation=cv2.INTER_AREA)
+
+
+def frame_signature(img: np.ndarray) -> bytes:
+    # 32x32 缩略图作为画面指纹：和上一次没命中的画面完全相同时，匹配结果也必然相同，可以跳过
+    return thumbnail(img).tobytes()
+
+
 def wait_and_click(template_name: str, timeout: float = 30.0, threshold: float = IMAGE_MATCH_THRESHOLD) -> bool:
     template = load_template(template_name)
     if template is None:
         raise ValueError(f"Template {template_name} not found in resources.")
-    start = time.time()
+    deadline = time.monotonic() + timeout
     is_initial_btn = template_name in ("quick_start", "next", "start_battle")
-    while time.time() - start < timeout:
+    last_sig = None
+    still = False
+    delay = WAIT_POLL_MIN
+    while time.monotonic() < deadline:
         check_pause_and_running()
         if is_initial_btn and SKIP_INITIAL_WAIT:
             print(f"[Skip] Skip waiting for {template_name}")
             return False
         img, (left, top, width, height) = capture_emulator()
-        pos = match_template(img, template, threshold)
-        if pos:
-            x, y = pos
-            screen_x = left + x
-            screen_y = top + y
-            pyautogui.click(screen_x, screen_y)
-            return True
-        time.sleep(0.5)
+        sig = frame_signature(img)
+        if sig != last_sig:
+            pos = match_tracked(img, template, threshold)
+            if pos:
+                x, y = pos
+                screen_x = left + x
+                screen_y = top + y
+                click_at(screen_x, screen_y)
+                return True
+            if still:
+                # 静止的画面刚开始变化（加载结束/过场开始），目标可能马上出现，回到最短间隔；
+                # 之后一直在动（动画菜单）就照常退避，不会每帧都重置成高频轮询
+                delay = WAIT_POLL_MIN
+            still = False
+            last_sig = sig
+        else:
+            still = True
+        time.sleep(delay)
+        delay = min(delay * WAIT_POLL_BACKOFF, WAIT_POLL_MAX)
     print(f"[Timeout] {template_name} not found in {timeout} seconds")
     return False
 
 
+def wait_for(template_name: str, max_wait: float = 1.0, poll: float = 0.05,
+             threshold: float = IMAGE_MATCH_THRESHOLD) -> Optional[Tuple[int, int]]:
+    # 轮询直到模板出现且位置在连续两帧里不再变化（动画结束），返回屏幕坐标；超时返回 None
+    template = load_template(template_name)
+    if template is None:
+        return None
+    deadline = time.monotonic() + max_wait
+    last_pos = None
+    while True:
+        img, rect = capture_emulator()
+        pos = match_tracked(img, template, threshold)
+        if pos:
+            screen_pos = (rect[0] + pos[0], rect[1] + pos[1])
+            if screen_pos == last_pos or time.monotonic() >= deadline:
+                return screen_pos
+            last_pos = screen_pos
+        else:
+            last_pos = None
+            if time.monotonic() >= deadline:
+                return None
+        time.sleep(poll)
+
+
+def click_and_wait_for(x: int, y: int, template_name: str, max_wait: float = 1.0, poll: float = 0.05,
+                       threshold: float = IMAGE_MATCH_THRESHOLD) -> Optional[Tuple[int, int]]:
+    # 代替“点击 + 固定 sleep + 截图匹配”：max_wait 取原来的 sleep 时长，出现得早就提前返回
+    click_at(x, y)
+    return wait_for(template_name, max_wait, poll, threshold)
+
+
 def click_relative(offset_x: int, offset_y: int, window_rect: Tuple[int, int, int, int], delay: float = 0.0):
     check_pause_and_running()
     left, top, _, _ = window_rect
-    pyautogui.click(left + offset_x, top + offset_y)
+    click_at(left + offset_x, top + offset_y)
     if delay:
         time.sleep(delay)
 
 
 def continuous_fast_click(delay: float = 0.05, duration: float = 2.0):
-    img, rect = capture_emulator()
-    left, top, width, height = rect
+    check_pause_and_running()
+    left, top, width, height = get_window_rect()
     click_x = left + 10
     click_y = top + height // 2
-    end_time = time.time() + duration
-    while time.time() < end_time:
+    # 每隔几次点击看一眼窗口中央的一小块，和开始时差别很大说明界面已经切换，提前结束连点
+    baseline = center_patch(capture_emulator().image).copy()
+    # 按绝对时间排点击：截图和比较的耗时从下一次 sleep 里扣掉，节奏不会被拖慢
+    start = time.perf_counter()
+    end_time = start + duration
+    next_at = start
+    clicks = 0
+    while next_at < end_time:
         check_pause_and_running()
-        pyautogui.click(click_x, click_y)
-        time.sleep(delay)
+        # 每次都重新定位光标：暂停期间用户可能移动过鼠标，SetCursorPos 本身很便宜
+        click_at(click_x, click_y)
+        clicks += 1
+        if clicks % FAST_CLICK_CHECK_EVERY == 0 and patch_changed(baseline, center_patch(capture_emulator().image)):
+            return
+        next_at += delay
+        remaining = next_at - time.perf_counter()
+        if remaining > 0:
+            time.sleep(remaining)
+        else:
+            # 落后太多（比如刚从暂停恢复）时不补发，从现在重新计时
+            next_at = time.perf_counter()
+
+
+def center_patch(img: np.ndarray, size: int = 64) -> np.ndarray:
+    h, w = img.shape[:2]
+    top, left = max(0, h // 2 - size // 2), max(0, w // 2 - size // 2)
+    return img[top:top + size, left:left + size]
+
 
+def patch_changed(before: np.ndarray, after: np.ndarray, ratio: float = FAST_CLICK_CHANGE_RATIO) -> bool:
+    # 只看像素差，不做模板匹配：变化明显（灰度差 > FAST_CLICK_PIXEL_DIFF）的像素超过 ratio 比例就算界面变了
+    if before.shape != after.shape:
+        return True
+    changed = np.count_nonzero(cv2.absdiff(before, after) > FAST_CLICK_PIXEL_DIFF)
+    return changed > ratio * after.size
 
-def select_choice_or_first():
-    select_icon = load_template("select")
-    choice_icon = load_template("choice")
 
-    img, rect = capture_emulator()
+def select_choice_or_first(frame: Optional[Frame] = None):
+    # frame 传入触发这次选择的那一帧时，主循环已经在这帧上匹配过的结果直接复用
+    if frame is None:
+        frame = capture_emulator()
     check_pause_and_running()
+    rect = frame.rect
+    found = scan_all(frame, {"select": 0.7, "choice": 0.8})
 
-    select_pos = match_template(img, select_icon, threshold=0.7) if select_icon is not None else None
+    select_pos = found["select"]
     if select_pos:
         sx, sy = select_pos
         print(f"[Debug] select matched at ({sx}, {sy})")
-        pyautogui.click(rect[0] + sx, rect[1] + sy)
+        click_at(rect[0] + sx, rect[1] + sy)
         time.sleep(0.3)
-        t0 = time.time()
-        while time.time() - t0 < 3:
+        deadline = time.monotonic() + 3.0
+        while time.monotonic() < deadline:
             check_pause_and_running()
             img2, rect2 = capture_emulator()
             conf_icon = load_template("select_confirm")
-            conf_pos = match_template(img2, conf_icon, threshold=0.7) if conf_icon is not None else None
+            conf_pos = match_tracked(img2, conf_icon, threshold=0.7) if conf_icon is not None else None
             if conf_pos:
                 cx, cy = conf_pos
                 print(f"[Debug] select_confirm matched at ({cx}, {cy})")
-                pyautogui.click(rect2[0] + cx, rect2[1] + cy)
+                click_at(rect2[0] + cx, rect2[1] + cy)
                 break
             time.sleep(0.2)
         return
 
-    choice_pos = match_template(img, choice_icon, threshold=0.8) if choice_icon is not None else None
+    choice_pos = found["choice"]
     if choice_pos:
         cx, cy = choice_pos
         print(f"[Debug] choice matched at ({cx}, {cy})")
-        pyautogui.click(rect[0] + cx, rect[1] + cy)
+        click_at(rect[0] + cx, rect[1] + cy)
         return
 
     left, top, width, height = rect
     x = left + int(width * 0.2)
     y = top + height // 2
     print(f"[Debug] fallback click at ({x}, {y})")
-    pyautogui.click(x, y)
+    click_at(x, y)
 
 
 def click_blank(rect):
@@ -215,21 +1132,57 @@ def click_blank(rect):
     left, top, width, height = rect
     x = left + 10
     y = top + height // 2
-    pyautogui.click(x, y)
+    click_at(x, y)
+
+
+def dismiss_popups(rect, max_clicks: int = 20, min_clicks: int = 8, interval: float = 0.05, still: int = 3):
+    # 购买后连续点空白关掉获得物品等弹窗：前 min_clicks 次只点不看；之后每次点完看一眼缩略图，
+    # 连续 still 次和上一张相比没有明显变化（容忍背景动画的小幅变化）就不用再点满 max_clicks 次
+    # 截图等待的时间算在点击间隔里，不额外拖长每次点击
+    last, unchanged = None, 0
+    for i in range(max_clicks):
+        click_blank(rect)
+        if i + 1 < min_clicks:
+            sleep(interval)
+            continue
+        next_at = time.perf_counter() + interval
+        thumb = thumbnail(capture_emulator().image)
+        unchanged = unchanged + 1 if last is not None and not patch_changed(last, thumb, POPUP_CHANGE_RATIO) else 0
+        last = thumb
+        if unchanged >= still:
+            return
+        remaining = next_at - time.perf_counter()
+        if remaining > 0:
+            sleep(remaining)
 
 
-def find_all_matches(img: np.ndarray, template: np.ndarray, threshold: float) -> list[tuple[int, int]]:
+def find_all_matches(img: np.ndarray, template: TemplateEntry, threshold: float,
+                     roi: Optional[Tuple[float, float, float, float]] = None) -> list[tuple[int, int]]:
     if img is None or template is None:
         return []
-    result = cv2.matchTemplate(img, template, cv2.TM_CCOEFF_NORMED)
-    ys, xs = np.where(result >= threshold)
-    if len(xs) == 0:
+    img, off_x, off_y = crop_roi(img, roi or template.roi)
+    if cannot_match(img, template):
         return []
-    t_h, t_w = template.shape[:2]
-    centers = [(int(x + t_w // 2), int(y + t_h // 2)) for x, y in zip(xs, ys)]
-    centers.sort(key=lambda p: (p[1], p[0]))
+    xs, ys = local_peaks(run_match(img, template.image), threshold, MATCH_NMS_RADIUS)
+    centers = [(int(x + template.half_w), int(y + template.half_h)) for x, y in zip(xs, ys)]
+    return [(off_x + x, off_y + y) for x, y in dedup_centers(centers)]
+
+
+def local_peaks(result: np.ndarray, threshold: float, radius: int) -> Tuple[np.ndarray, np.ndarray]:
+    # 非极大值抑制：dilate 得到每个点 (2r+1)^2 邻域内的最大值，等于自身且过阈值的点才是峰
+    # 同一图标周围一圈过阈值的点只留下中心，剩下的少量点（平台上等值的峰）再交给 dedup_centers
+    mask = result >= threshold
+    if not mask.any():
+        return np.empty(0, np.intp), np.empty(0, np.intp)
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (2 * radius + 1, 2 * radius + 1))
+    ys, xs = np.nonzero(mask & (result >= cv2.dilate(result, kernel)))
+    return xs, ys
+
+
+def dedup_centers(centers: list[tuple[int, int]], min_dist: int = 20) -> list[tuple[int, int]]:
+    # 按 (y, x) 排序后贪心保留：只和已经保留的点比距离。NMS 之后剩下的点很少，循环的开销可以忽略
+    centers = sorted(centers, key=lambda p: (p[1], p[0]))
     filtered = []
-    min_dist = 20
     for cx, cy in centers:
         ok = True
         for fx, fy in filtered:
@@ -242,89 +1195,76 @@ def find_all_matches(img: np.ndarray, template: np.ndarray, threshold: float) ->
 
 
 def handle_shop(final_shop: bool = False):
+    # 气泡位置只和窗口尺寸有关，进商店时算一次，不用每次点气泡都截图
+    shop_rect = get_window_rect()
+    bubble_y_positions = [int(0.40 * shop_rect[3]), int(0.60 * shop_rect[3]), int(0.75 * shop_rect[3])]
+
     def click_bubble(index: int):
-        img, rect = capture_emulator()
-        h = rect[3]
-        bubble_y_positions = [int(0.40 * h), int(0.60 * h), int(0.75 * h)]
-        click_relative(500, bubble_y_positions[index], rect)
+        click_relative(500, bubble_y_positions[index], shop_rect)
         time.sleep(0.8)
 
     def purchase_items():
         note_template = load_template("note")
         hundred_template = load_template("hundred")
-        buy_template = load_template("buy")
-        confirm_template = load_template("confirm")
         if note_template is None and hundred_template is None:
             return
 
-        # 先买所有 note（用 sold_out 标记过滤，避免重复点已买过/已售罄的格子）
-        sold_out_template = load_template("sold_out")
-
-        def is_near_any(x: int, y: int, points: list[tuple[int, int]], dist: int = 45) -> bool:
+        def drop_near(points: list[tuple[int, int]], marks: list[tuple[int, int]], dist: int = 45) -> list[tuple[int, int]]:
+            # 去掉曼哈顿距离 dist 以内有标记的点，所有点和标记一次算成距离矩阵
             # dist 可调：售罄标记和物品图标通常很近，45~70 都常用
-            for px, py in points:
-                if abs(x - px) + abs(y - py) <= dist:
-                    return True
-            return False
+            if not points or not marks:
+                return list(points)
+            p = np.asarray(points, np.int32)
+            m = np.asarray(marks, np.int32)
+            near = (np.abs(p[:, None, :] - m[None, :, :]).sum(axis=2) <= dist).any(axis=1)
+            return [pt for pt, hit in zip(points, near) if not hit]
 
+        # 先买所有 note（用 sold_out 标记过滤，避免重复点已买过/已售罄的格子）
         while True:
             check_pause_and_running()
-            img, rect = capture_emulator()
+            frame = capture_emulator()
+            rect = frame.rect
 
-            note_positions = find_all_matches(img, note_template, 0.8) if note_template is not None else []
+            # note 和 sold_out 在同一帧上并行扫描，sold_out 作为“已售罄/已购买”的标记列表
+            found = scan_all(frame, {"note": 0.8, "sold_out": 0.8}, func=find_all_matches)
+            note_positions = found["note"]
             if not note_positions:
                 break
-
-            # 一次性扫描所有 sold_out，作为“已售罄/已购买”的标记列表
-            sold_positions = []
-            if sold_out_template is not None:
-                sold_positions = find_all_matches(img, sold_out_template, 0.8)
+            sold_positions = found["sold_out"]
 
             # 过滤掉“旁边已经有 sold_out 标记”的 note
-            filtered_notes = [p for p in note_positions if not is_near_any(p[0], p[1], sold_positions, dist=150)]
+            filtered_notes = drop_near(note_positions, sold_positions, dist=150)
             if not filtered_notes:
                 # 当前屏所有 note 都已经售罄/买过（或被标记了），结束 note 购买
                 break
 
             any_bought = False
 
+            # 一次扫描得到的所有 note 依次购买，整张列表买完才重新整屏扫描
             for cx, cy in filtered_notes:
                 check_pause_and_running()
-
-                # 点 note
-                img1, rect1 = capture_emulator()
-                pyautogui.click(rect1[0] + cx, rect1[1] + cy)
-                time.sleep(0.25)
-
-                # 点 buy
-                img2, rect2 = capture_emulator()
-                buy_pos = match_template(img2, buy_template, threshold=0.8)
+                if any_bought:
+                    # 上一件买完后界面可能有变化，只在这件商品附近确认 note 还在，避免点到已变化的 UI
+                    img, rect = capture_emulator()
+                    if not match_near(img, note_template, cx, cy, 0.8):
+                        continue
+
+                # 点 note，等 buy 出现
+                buy_pos = click_and_wait_for(rect[0] + cx, rect[1] + cy, "buy", max_wait=0.25)
                 if not buy_pos:
                     continue
-                bx, by = buy_pos
-                pyautogui.click(rect2[0] + bx, rect2[1] + by)
-                time.sleep(0.35)
-
-                # confirm（如果有）
-                img3, rect3 = capture_emulator()
-                conf_pos = match_template(img3, confirm_template,
-                                          threshold=0.8) if confirm_template is not None else None
+
+                # 点 buy，等 confirm（如果有）
+                conf_pos = click_and_wait_for(*buy_pos, "confirm", max_wait=0.35)
                 if conf_pos:
-                    kx, ky = conf_pos
-                    pyautogui.click(rect3[0] + kx, rect3[1] + ky)
+                    click_at(*conf_pos)
                     time.sleep(0.2)
 
                 # 收尾点击空白
-                for _ in range(20):
-                    click_blank(rect3)
-                    sleep(0.05)
+                dismiss_popups(rect)
 
                 any_bought = True
 
-                #  关键：买完后立刻重新截图，让 sold_out 出现/刷新，然后下一轮再过滤
-                # （避免这一轮坐标列表继续点到已变化的 UI）
-                break
-
             if not any_bought:
                 # 有 note 但全都买不了，防止死循环
                 print("debug: no more purchasable notes found, breaking out of loop")
@@ -333,30 +1273,21 @@ def handle_shop(final_shop: bool = False):
             time.sleep(0.2)
 
         # 再买所有 100，并在每次买完后走大拇指 + 拿走 + 空白（加入 sold_out 过滤）
-        sold_out_template = load_template("sold_out")
-
-        def is_near_any(x: int, y: int, points: list[tuple[int, int]], dist: int = 45) -> bool:
-            for px, py in points:
-                if abs(x - px) + abs(y - py) <= dist:
-                    return True
-            return False
-
         while True:
             check_pause_and_running()
-            img, rect = capture_emulator()
+            frame = capture_emulator()
+            rect = frame.rect
 
-            hundred_positions = find_all_matches(img, hundred_template, 0.9) if hundred_template is not None else []
+            # 100 和当前屏所有 sold_out 标记并行扫描
+            found = scan_all(frame, {"hundred": 0.9, "sold_out": 0.8}, func=find_all_matches)
+            hundred_positions = found["hundred"]
             if not hundred_positions:
                 print("debug: no more purchasable 100s found, breaking out of loop")
                 break
-
-            # 扫描当前屏所有 sold_out 标记
-            sold_positions = []
-            if sold_out_template is not None:
-                sold_positions = find_all_matches(img, sold_out_template, 0.8)
+            sold_positions = found["sold_out"]
 
             #  过滤掉“旁边有 sold_out 标记”的 100
-            filtered_hundreds = [p for p in hundred_positions if not is_near_any(p[0], p[1], sold_positions, dist=150)]
+            filtered_hundreds = drop_near(hundred_positions, sold_positions, dist=150)
             if not filtered_hundreds:
                 print("debug: all 100s are sold out (filtered), breaking out of loop")
                 break
@@ -365,39 +1296,28 @@ def handle_shop(final_shop: bool = False):
 
             for cx, cy in filtered_hundreds:
                 check_pause_and_running()
-                img1, rect1 = capture_emulator()
-                pyautogui.click(rect1[0] + cx, rect1[1] + cy)
-                time.sleep(0.3)
-
-                img2, rect2 = capture_emulator()
-                buy_pos = match_template(img2, buy_template, threshold=0.8)
+                if bought_one:
+                    img, rect = capture_emulator()
+                    if not match_near(img, hundred_template, cx, cy, 0.9):
+                        continue
+                buy_pos = click_and_wait_for(rect[0] + cx, rect[1] + cy, "buy", max_wait=0.3)
                 if not buy_pos:
                     # 点了但没出现 buy：很可能是售罄/不可买，跳过
                     continue
 
-                bx, by = buy_pos
-                pyautogui.click(rect2[0] + bx, rect2[1] + by)
-                time.sleep(0.4)
-
-                img3, rect3 = capture_emulator()
-                conf_pos = match_template(img3, confirm_template,
-                                          threshold=0.8) if confirm_template is not None else None
+                conf_pos = click_and_wait_for(*buy_pos, "confirm", max_wait=0.4)
                 if conf_pos:
-                    kx, ky = conf_pos
-                    pyautogui.click(rect3[0] + kx, rect3[1] + ky)
+                    click_at(*conf_pos)
                     time.sleep(0.2)
 
-                click_blank(rect3)
-                click_blank(rect3)
-                click_blank(rect3)
+                click_blank(rect)
+                click_blank(rect)
+                click_blank(rect)
                 time.sleep(0.8)
 
                 take_thumb_reward()
                 bought_one = True
 
-                # 买完一个就 break，下一轮重新截图重新过滤 sold_out（避免坐标重排/假命中）
-                break
-
             if not bought_one:
                 print("debug: found 100s but none could be bought (no buy button), breaking to avoid loop")
                 break
@@ -405,27 +1325,27 @@ def handle_shop(final_shop: bool = False):
             time.sleep(0.2)
 
     def take_thumb_reward(timeout: float = 6.0):
-        start = time.time()
+        deadline = time.monotonic() + timeout
         select_icon = load_template("select")
         confirm_icon = load_template("select_confirm")
         if select_icon is None or confirm_icon is None:
             return
-        while time.time() - start < timeout:
+        while time.monotonic() < deadline:
             check_pause_and_running()
             img, rect = capture_emulator()
             select_pos = match_template(img, select_icon, threshold=0.7)
             if select_pos:
                 sx, sy = select_pos
-                pyautogui.click(rect[0] + sx, rect[1] + sy)
+                click_at(rect[0] + sx, rect[1] + sy)
                 time.sleep(0.3)
-                t0 = time.time()
-                while time.time() - t0 < 3.0:
+                confirm_deadline = time.monotonic() + 3.0
+                while time.monotonic() < confirm_deadline:
                     check_pause_and_running()
                     img2, rect2 = capture_emulator()
-                    conf_pos = match_template(img2, confirm_icon, threshold=0.7)
+                    conf_pos = match_tracked(img2, confirm_icon, threshold=0.7)
                     if conf_pos:
                         cx, cy = conf_pos
-                        pyautogui.click(rect2[0] + cx, rect2[1] + cy)
+                        click_at(rect2[0] + cx, rect2[1] + cy)
                         time.sleep(0.2)
                         click_blank(rect2)
                         return
@@ -454,7 +1374,7 @@ def handle_shop(final_shop: bool = False):
             if pos:
                 x, y = pos
                 time.sleep(0.3)
-                pyautogui.click(rect[0] + x, rect[1] + y)
+                click_at(rect[0] + x, rect[1] + y)
                 time.sleep(0.1)
                 purchase_items()
                 refreshes += 1
@@ -469,7 +1389,7 @@ def handle_shop(final_shop: bool = False):
                 time.sleep(0.5)
                 click_blank(rect)
                 x, y = back_pos
-                pyautogui.click(rect[0] + x, rect[1] + y)
+                click_at(rect[0] + x, rect[1] + y)
                 print("debug : quit shop after 2 refreshes")
                 time.sleep(0.5)
 
@@ -480,7 +1400,7 @@ def handle_shop(final_shop: bool = False):
         back_pos = match_template(img, back_template, threshold=0.8)
         if back_pos:
             x, y = back_pos
-            pyautogui.click(rect[0] + x, rect[1] + y)
+            click_at(rect[0] + x, rect[1] + y)
             print("debug : quit shop")
             time.sleep(0.5)
         else:
@@ -496,12 +1416,20 @@ def handle_shop(final_shop: bool = False):
             confirm_pos = match_template(img, confirm_template, threshold=0.8)
             if confirm_pos:
                 cx, cy = confirm_pos
-                pyautogui.click(rect[0] + cx, rect[1] + cy)
+                click_at(rect[0] + cx, rect[1] + cy)
                 time.sleep(0.5)
 
 
 
 def main_loop():
+    start_frame_grabber()
+    try:
+        run_tower()
+    finally:
+        stop_frame_grabber()
+
+
+def run_tower():
     global SKIP_INITIAL_WAIT
     print("Waiting for 快速战斗 (press S to skip initial waits, P pause, Q quit)")
     wait_and_click("quick_start", timeout=60)
@@ -513,44 +1441,50 @@ def main_loop():
     print("Entered tower run. Starting automation…")
     shop_counter = 0
     max_shops = 4
+    idle_sig = None
+    # 每组的 {模板名: 阈值} 在循环外拷贝一次，商店数满之后从 battle 组里去掉 enter_shop
+    groups = {group: dict(names) for group, names in MAIN_LOOP_GROUPS.items()}
     while True:
         check_pause_and_running()
         continuous_fast_click(delay=0.05, duration=1.5)
-        img, rect = capture_emulator()
-        save_template = load_template("save")
-        save_pos = match_template(img, save_template, threshold=0.8)
+        frame = capture_emulator()
+        rect = frame.rect
+        sig = frame_signature(frame.image)
+        if sig == idle_sig:
+            time.sleep(0.2)
+            continue
+        # 保存/商店优先于选项：battle 组命中时不再匹配 dialog 组，两组都没命中时四个模板都会匹配一遍
+        matches = {}
+        for group in ("battle", "dialog"):
+            matches = scan_all(frame, groups[group])
+            if any(matches.values()):
+                break
+        save_pos = matches.get("save")
         if save_pos:
             sx, sy = save_pos
-            pyautogui.click(rect[0] + sx, rect[1] + sy)
             print("Found 保存记录. Exiting run…")
-            time.sleep(0.5)
-
-            confirm_template = load_template("confirm")
-            if confirm_template is not None:
-                img2, rect2 = capture_emulator()
-                conf_pos = match_template(img2, confirm_template, threshold=0.8)
-                if conf_pos:
-                    cx, cy = conf_pos
-                    pyautogui.click(rect2[0] + cx, rect2[1] + cy)
-                    time.sleep(1.5)
+            conf_pos = click_and_wait_for(rect[0] + sx, rect[1] + sy, "confirm", max_wait=0.5)
+            if conf_pos:
+                click_at(*conf_pos)
+                time.sleep(1.5)
             break
-        enter_shop_template = load_template("enter_shop")
-        shop_pos = match_template(img, enter_shop_template, threshold=0.8)
-        if shop_pos and shop_counter < max_shops:
+        shop_pos = matches.get("enter_shop")
+        if shop_pos:
             print(f"Encountered shop {shop_counter + 1}")
             final_shop = shop_counter == max_shops - 1
             handle_shop(final_shop=final_shop)
             shop_counter += 1
+            if shop_counter >= max_shops:
+                groups["battle"].pop("enter_shop", None)
             continue
-        select_template = load_template("select")
-        choice_template = load_template("choice")
-        select_pos = match_template(img, select_template, threshold=0.7) if select_template is not None else None
-        choice_pos = match_template(img, choice_template, threshold=0.8) if choice_template is not None else None
+        select_pos = matches.get("select")
+        choice_pos = matches.get("choice")
         if select_pos or choice_pos:
             print(f"[Debug] select_pos={select_pos}, choice_pos={choice_pos}")
-            select_choice_or_first()
+            select_choice_or_first(frame)
             continue
 
+        idle_sig = sig
         time.sleep(0.2)
     print("Automation complete.")
 
@@ -560,6 +1494,9 @@ if __name__ == "__main__":
     keyboard.add_hotkey("s", mark_skip_initial)
     keyboard.add_hotkey("q", stop_running)
     print("Hotkeys: P=pause/resume, S=skip initial waits, Q=quit")
+    missing_templates = preload_templates()
+    if missing_templates:
+        print(f"[Warn] Templates not found in resources: {', '.join(missing_templates)}")
 
     MAX_RUNS = 7
     run_count = 0